@@ -1,18 +1,86 @@
 
 from __future__ import annotations
 
+import os
+
+if os.environ.get("GEVENT"):
+    # Patch socket and file I/O before anything but os is imported so slow
+    # clients and static file serving don't hold up other requests. SQLite
+    # calls and the matcher are not cooperative and still block the worker.
+    # Not needed under `gunicorn -k gevent`, which patches on its own. db
+    # shares one connection per process, opened with check_same_thread=False
+    # and guarded by a (patched) lock.
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import sqlite3
+from itertools import groupby
+from operator import itemgetter
 from typing import Any, Dict, List
 from pathlib import Path
 
-from flask import Flask, jsonify, request, send_from_directory
-from flask_cors import CORS
+import orjson
+from flask import Flask, Response, request, send_from_directory
+from flask.json.provider import JSONProvider
 
 from . import db, matching
 
 
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+# Seconds browsers may reuse app.js/styles.css before revalidating
+ASSET_MAX_AGE = 3600
+
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson instead of the stdlib encoder."""
+
+    option = orjson.OPT_NON_STR_KEYS
+
+    @staticmethod
+    def default(obj: Any) -> Any:
+        # db.fetch_all/fetch_one hand back sqlite3.Row objects as-is
+        if isinstance(obj, sqlite3.Row):
+            return dict(obj)
+        raise TypeError
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # Hand orjson's bytes straight to the response, skipping the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.option),
+            mimetype="application/json",
+        )
+
+
+def _split_ids(concatenated: str | None) -> List[int]:
+    """Parse a GROUP_CONCAT result like "1,3,4" into a list of ints."""
+    if not concatenated:
+        return []
+    return [int(x) for x in concatenated.split(",")]
+
+
 def create_app() -> Flask:
     app = Flask(__name__)
-    CORS(app)
+    app.json = ORJSONProvider(app)
+
+    @app.after_request
+    def add_cors_headers(response: Response) -> Response:
+        # Open API, no credentials: a fixed header set is all CORS needs here.
+        # Preflights are answered by Flask's automatic OPTIONS handling.
+        response.headers.update(CORS_HEADERS)
+        return response
 
     # Ensure schema and seed data exist
     db.init_db()
@@ -22,18 +90,22 @@ def create_app() -> Flask:
 
     # --- Frontend assets ---
 
+    # Asset names are not content-hashed, so browsers cache them for a while
+    # and then revalidate via ETag/Last-Modified (a 304 skips re-reading the file).
+    # The page itself is always revalidated so new asset versions are picked up.
+
     @app.get("/")
     def index() -> Any:
         """Serve the main frontend page."""
-        return send_from_directory(frontend_dir, "index.html")
+        return send_from_directory(frontend_dir, "index.html", max_age=0)
 
     @app.get("/app.js")
     def app_js() -> Any:
-        return send_from_directory(frontend_dir, "app.js")
+        return send_from_directory(frontend_dir, "app.js", max_age=ASSET_MAX_AGE)
 
     @app.get("/styles.css")
     def styles_css() -> Any:
-        return send_from_directory(frontend_dir, "styles.css")
+        return send_from_directory(frontend_dir, "styles.css", max_age=ASSET_MAX_AGE)
 
     @app.get("/api/health")
     def health() -> Any:
@@ -44,59 +116,49 @@ def create_app() -> Flask:
     @app.get("/api/courses")
     def get_courses() -> Any:
         courses = db.fetch_all("SELECT id, code, name FROM courses ORDER BY code")
-        return jsonify(courses)
+        return app.json.response(courses)
 
     @app.get("/api/timeslots")
     def get_timeslots() -> Any:
         timeslots = db.fetch_all(
             "SELECT id, label, day_of_week, start_time, end_time FROM timeslots ORDER BY day_of_week, start_time"
         )
-        return jsonify(timeslots)
+        return app.json.response(timeslots)
 
     # --- Students ---
 
     @app.get("/api/students")
     def list_students() -> Any:
+        # course_ids and availability are attached for convenience; SQLite
+        # aggregates them per student so no Python-side merge is needed.
         students = db.fetch_all(
-            "SELECT id, name, email, preferred_group_size FROM students ORDER BY created_at DESC"
-        )
-
-        if not students:
-            return jsonify([])
-
-        # attach course_ids and availability for convenience
-        student_ids = [s["id"] for s in students]
-
-        courses_rows = db.fetch_all(
-            "SELECT student_id, course_id FROM student_courses WHERE student_id IN (%s)"
-            % ",".join(["?"] * len(student_ids)),
-            student_ids,
-        )
-        times_rows = db.fetch_all(
-            "SELECT student_id, timeslot_id FROM student_availability WHERE student_id IN (%s)"
-            % ",".join(["?"] * len(student_ids)),
-            student_ids,
+            """
+            SELECT s.id,
+                   s.name,
+                   s.email,
+                   s.preferred_group_size,
+                   (SELECT GROUP_CONCAT(course_id) FROM student_courses
+                     WHERE student_id = s.id) AS course_ids,
+                   (SELECT GROUP_CONCAT(timeslot_id) FROM student_availability
+                     WHERE student_id = s.id) AS availability_timeslot_ids
+            FROM students s
+            ORDER BY s.created_at DESC
+            """
         )
 
-        by_student_courses: Dict[int, List[int]] = {sid: [] for sid in student_ids}
-        for row in courses_rows:
-            by_student_courses.setdefault(row["student_id"], []).append(row["course_id"])
-
-        by_student_times: Dict[int, List[int]] = {sid: [] for sid in student_ids}
-        for row in times_rows:
-            by_student_times.setdefault(row["student_id"], []).append(row["timeslot_id"])
+        enriched: List[Dict[str, Any]] = [
+            {
+                "id": row["id"],
+                "name": row["name"],
+                "email": row["email"],
+                "preferred_group_size": row["preferred_group_size"],
+                "course_ids": _split_ids(row["course_ids"]),
+                "availability_timeslot_ids": _split_ids(row["availability_timeslot_ids"]),
+            }
+            for row in students
+        ]
 
-        enriched: List[Dict[str, Any]] = []
-        for s in students:
-            enriched.append(
-                {
-                    **s,
-                    "course_ids": by_student_courses.get(s["id"], []),
-                    "availability_timeslot_ids": by_student_times.get(s["id"], []),
-                }
-            )
-
-        return jsonify(enriched)
+        return app.json.response(enriched)
 
     @app.post("/api/students")
     def upsert_student() -> Any:
@@ -104,56 +166,65 @@ def create_app() -> Flask:
 
         name = (data.get("name") or "").strip()
         email = (data.get("email") or "").strip().lower()
-        preferred_group_size = int(data.get("preferred_group_size") or 3)
-        course_ids = data.get("course_ids") or []
-        availability_ids = data.get("availability_timeslot_ids") or []
 
         if not name or not email:
-            return jsonify({"error": "name and email are required"}), 400
+            return app.json.response({"error": "name and email are required"}), 400
 
         # Clamp preferred group size
-        preferred_group_size = max(2, min(5, preferred_group_size))
-
-        existing = db.fetch_one("SELECT id FROM students WHERE email = ?", (email,))
-        if existing:
-            student_id = existing["id"]
-            db.execute(
-                "UPDATE students SET name = ?, preferred_group_size = ? WHERE id = ?",
-                (name, preferred_group_size, student_id),
+        preferred_group_size = min(5, max(2, int(data.get("preferred_group_size") or 3)))
+
+        # Coerce and deduplicate in one pass so repeated ids never reach SQLite
+        course_ids = {int(cid) for cid in data.get("course_ids") or ()}
+        availability_ids = {int(tid) for tid in data.get("availability_timeslot_ids") or ()}
+
+        with db.transaction():
+            # Update by email first and only insert when no row matched; an
+            # upsert would burn an AUTOINCREMENT id on every re-save.
+            # RETURNING saves a follow-up SELECT either way.
+            student = db.fetch_one(
+                """
+                UPDATE students SET name = ?, preferred_group_size = ?
+                WHERE email = ?
+                RETURNING id, name, email, preferred_group_size
+                """,
+                (name, preferred_group_size, email),
             )
-            # Clear old relations
+            if student is None:
+                student = db.fetch_one(
+                    """
+                    INSERT INTO students (name, email, preferred_group_size)
+                    VALUES (?, ?, ?)
+                    RETURNING id, name, email, preferred_group_size
+                    """,
+                    (name, email, preferred_group_size),
+                )
+            student_id = student["id"]
+
+            # Clear old relations (no-op for a new student)
             db.execute("DELETE FROM student_courses WHERE student_id = ?", (student_id,))
             db.execute(
                 "DELETE FROM student_availability WHERE student_id = ?", (student_id,)
             )
-        else:
-            student_id = db.execute(
-                "INSERT INTO students (name, email, preferred_group_size) VALUES (?, ?, ?)",
-                (name, email, preferred_group_size),
-            )
 
-        # (Re)insert course memberships
-        if course_ids:
-            values = [(student_id, int(cid)) for cid in course_ids]
-            db.executemany(
-                "INSERT OR IGNORE INTO student_courses (student_id, course_id) VALUES (?, ?)",
-                values,
-            )
+            # (Re)insert course memberships
+            if course_ids:
+                values = [(student_id, cid) for cid in course_ids]
+                db.executemany(
+                    "INSERT OR IGNORE INTO student_courses (student_id, course_id) VALUES (?, ?)",
+                    values,
+                )
 
-        # (Re)insert availability
-        if availability_ids:
-            values = [(student_id, int(tid)) for tid in availability_ids]
-            db.executemany(
-                "INSERT OR IGNORE INTO student_availability (student_id, timeslot_id) VALUES (?, ?)",
-                values,
-            )
+            # (Re)insert availability
+            if availability_ids:
+                values = [(student_id, tid) for tid in availability_ids]
+                db.executemany(
+                    "INSERT OR IGNORE INTO student_availability (student_id, timeslot_id) VALUES (?, ?)",
+                    values,
+                )
 
-        student = db.fetch_one(
-            "SELECT id, name, email, preferred_group_size FROM students WHERE id = ?",
-            (student_id,),
-        )
+            db.bump_students_version()
 
-        return jsonify(student), 201
+        return app.json.response(student), 201
 
     # --- Matching & groups ---
 
@@ -161,64 +232,31 @@ def create_app() -> Flask:
     def run_match() -> Any:
         """Run matching and return detailed group structures."""
 
-        matching_result = matching.run_matching()
-        if not matching_result:
-            return jsonify({"groups": []})
+        matched = matching.run_matching()
+        if not matched:
+            return app.json.response({"groups": []})
 
-        # Load groups from DB to build a human-friendly response
-        group_rows = db.fetch_all(
-            """
-            SELECT sg.id AS group_id,
-                   sg.course_id,
-                   sg.group_index,
-                   c.code AS course_code,
-                   c.name AS course_name
-            FROM study_groups sg
-            JOIN courses c ON c.id = sg.course_id
-            ORDER BY c.code, sg.group_index
-            """
-        )
-
-        if not group_rows:
-            return jsonify({"groups": []})
-
-        member_rows = db.fetch_all(
-            """
-            SELECT sgm.group_id,
-                   s.id AS student_id,
-                   s.name,
-                   s.email
-            FROM study_group_members sgm
-            JOIN students s ON s.id = sgm.student_id
-            ORDER BY s.name
-            """
-        )
-
-        members_by_group: Dict[int, List[Dict[str, Any]]] = {}
-        for row in member_rows:
-            members_by_group.setdefault(row["group_id"], []).append(
-                {
-                    "id": row["student_id"],
-                    "name": row["name"],
-                    "email": row["email"],
-                }
-            )
+        # Members come straight from the matcher; only course labels are looked up
+        courses = {
+            row["id"]: row for row in db.fetch_all("SELECT id, code, name FROM courses")
+        }
 
         groups: List[Dict[str, Any]] = []
-        for row in group_rows:
-            gid = row["group_id"]
+        for group in matched:
+            course = courses[group["course_id"]]
             groups.append(
                 {
-                    "group_id": gid,
-                    "course_id": row["course_id"],
-                    "course_code": row["course_code"],
-                    "course_name": row["course_name"],
-                    "group_index": row["group_index"],
-                    "members": members_by_group.get(gid, []),
+                    "group_id": group["group_id"],
+                    "course_id": group["course_id"],
+                    "course_code": course["code"],
+                    "course_name": course["name"],
+                    "group_index": group["group_index"],
+                    "members": sorted(group["members"], key=lambda m: m["name"]),
                 }
             )
+        groups.sort(key=lambda g: (g["course_code"], g["group_index"]))
 
-        return jsonify({"groups": groups})
+        return app.json.response({"groups": groups})
 
     @app.get("/api/groups")
     def get_groups() -> Any:
@@ -238,7 +276,7 @@ def create_app() -> Flask:
         )
 
         if not group_rows:
-            return jsonify({"groups": []})
+            return app.json.response({"groups": []})
 
         member_rows = db.fetch_all(
             """
@@ -248,19 +286,22 @@ def create_app() -> Flask:
                    s.email
             FROM study_group_members sgm
             JOIN students s ON s.id = sgm.student_id
-            ORDER BY s.name
+            ORDER BY sgm.group_id, s.name
             """
         )
 
-        members_by_group: Dict[int, List[Dict[str, Any]]] = {}
-        for row in member_rows:
-            members_by_group.setdefault(row["group_id"], []).append(
+        # Rows are sorted by group, so each group's members are one contiguous run
+        members_by_group: Dict[int, List[Dict[str, Any]]] = {
+            gid: [
                 {
                     "id": row["student_id"],
                     "name": row["name"],
                     "email": row["email"],
                 }
-            )
+                for row in rows
+            ]
+            for gid, rows in groupby(member_rows, key=itemgetter("group_id"))
+        }
 
         groups: List[Dict[str, Any]] = []
         for row in group_rows:
@@ -276,7 +317,7 @@ def create_app() -> Flask:
                 }
             )
 
-        return jsonify({"groups": groups})
+        return app.json.response({"groups": groups})
 
     return app
 
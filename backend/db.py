@@ -1,22 +1,81 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Iterable, Iterator, List, Optional
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DB_PATH = BASE_DIR / "study_groups.db"
 
+# One connection per process, shared by every request. The lock serializes
+# access so concurrent requests can't interleave statements inside each
+# other's transactions; it is reentrant so transaction() can nest.
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.RLock()
+
 
 def get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+    # Autocommit mode: writes commit on their own unless wrapped in transaction().
+    # The connection is long-lived, so keep every query text the app uses
+    # prepared in the statement cache.
+    conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=256,
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.executescript(
+        """
+        PRAGMA foreign_keys = ON;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA cache_size = -64000;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA temp_store = MEMORY;
+        """
+    )
     return conn
 
 
+@contextmanager
+def _connection() -> Iterator[sqlite3.Connection]:
+    """Hold the shared connection (opened on first use) for the block."""
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = get_connection()
+        yield _conn
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Group several writes into a single commit.
+
+    Nested calls join the outer transaction.
+    """
+    with _connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            # SQLite already rolled back after some errors (e.g. SQLITE_FULL,
+            # SQLITE_IOERR); a second ROLLBACK would mask the real error
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
 def init_db() -> None:
     conn = get_connection()
     cur = conn.cursor()
 
+    # WAL is persisted in the database file, so setting it once here is enough
+    cur.execute("PRAGMA journal_mode = WAL;")
+
     cur.executescript(
         """
         CREATE TABLE IF NOT EXISTS students (
@@ -73,11 +132,21 @@ def init_db() -> None:
             FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE
         );
 
+        -- Bumped whenever students or their courses/availability change, so
+        -- derived data (e.g. the matcher's input) can be cached per version.
+        -- Kept in the database so every worker process sees the same value.
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO data_versions (name, version) VALUES ('students', 0);
+
         CREATE INDEX IF NOT EXISTS idx_student_courses_student ON student_courses(student_id);
         CREATE INDEX IF NOT EXISTS idx_student_courses_course ON student_courses(course_id);
         CREATE INDEX IF NOT EXISTS idx_student_availability_student ON student_availability(student_id);
         CREATE INDEX IF NOT EXISTS idx_student_availability_timeslot ON student_availability(timeslot_id);
         CREATE INDEX IF NOT EXISTS idx_study_groups_course ON study_groups(course_id);
+        CREATE INDEX IF NOT EXISTS idx_study_group_members_student ON study_group_members(student_id);
         """
     )
 
@@ -111,38 +180,42 @@ def init_db() -> None:
     conn.close()
 
 
-def fetch_all(query: str, params: Iterable[Any] = ()) -> List[Dict[str, Any]]:
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, tuple(params))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+def students_version() -> int:
+    """Current version of the students data; see bump_students_version()."""
+    with _connection() as conn:
+        return conn.execute(
+            "SELECT version FROM data_versions WHERE name = 'students'"
+        ).fetchone()[0]
 
 
-def fetch_one(query: str, params: Iterable[Any] = ()) -> Optional[Dict[str, Any]]:
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, tuple(params))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+def bump_students_version() -> None:
+    """Mark students, student_courses or student_availability as changed.
+
+    Call inside the same transaction as the write.
+    """
+    with _connection() as conn:
+        conn.execute(
+            "UPDATE data_versions SET version = version + 1 WHERE name = 'students'"
+        )
+
+
+def fetch_all(query: str, params: Iterable[Any] = ()) -> List[sqlite3.Row]:
+    """Return rows as sqlite3.Row (indexable by column name, not copied to dicts)."""
+    with _connection() as conn:
+        return conn.execute(query, tuple(params)).fetchall()
+
+
+def fetch_one(query: str, params: Iterable[Any] = ()) -> Optional[sqlite3.Row]:
+    with _connection() as conn:
+        return conn.execute(query, tuple(params)).fetchone()
 
 
 def execute(query: str, params: Iterable[Any] = ()) -> int:
     """Execute a write query and return last row id if applicable."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, tuple(params))
-    conn.commit()
-    lastrowid = cur.lastrowid
-    conn.close()
-    return lastrowid
+    with _connection() as conn:
+        return conn.execute(query, tuple(params)).lastrowid
 
 
 def executemany(query: str, seq_of_params: Iterable[Iterable[Any]]) -> None:
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.executemany(query, [tuple(p) for p in seq_of_params])
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.executemany(query, [tuple(p) for p in seq_of_params])
@@ -1,210 +1,282 @@
-from collections import defaultdict
-from statistics import median
-from typing import Dict, List, Set, Tuple
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from numba import njit
 
 from . import db
-from .models import Student
+from .models import StudentArrays
+
+BASE_SCORE = 5
 
 
-def load_students_by_course() -> Dict[int, List[Student]]:
+def load_students_by_course() -> Dict[int, StudentArrays]:
     """Load students and group them by course_id.
 
-    Returns a dict: {course_id: [Student, ...]}
+    Returns a dict: {course_id: StudentArrays}, students ordered by id.
+    The result is cached until the students data version changes, so it is
+    shared between calls and its arrays are read-only.
     """
+    return _load_students_by_course(db.students_version())
+
+
+@lru_cache(maxsize=1)
+def _load_students_by_course(version: int) -> Dict[int, StudentArrays]:
     # Get all students
     students_rows = db.fetch_all(
-        "SELECT id, name, email, preferred_group_size FROM students"
+        "SELECT id, name, email, preferred_group_size FROM students ORDER BY id"
     )
     if not students_rows:
         return {}
 
-    # Map student_id -> base info
-    students_base: Dict[int, Student] = {}
-    for row in students_rows:
-        students_base[row["id"]] = Student(
-            id=row["id"],
-            name=row["name"],
-            email=row["email"],
-            preferred_group_size=row["preferred_group_size"],
-            course_ids=[],
-            availability_timeslot_ids=set(),
-        )
-
-    # Load course memberships
-    course_rows = db.fetch_all(
-        "SELECT student_id, course_id FROM student_courses"
+    ids = np.array([row["id"] for row in students_rows], dtype=np.int64)
+    prefs = np.array(
+        [row["preferred_group_size"] for row in students_rows], dtype=np.int8
     )
-    for row in course_rows:
-        sid = row["student_id"]
-        cid = row["course_id"]
-        if sid in students_base:
-            students_base[sid].course_ids.append(cid)
+    names = np.array([row["name"] for row in students_rows], dtype=object)
+    emails = np.array([row["email"] for row in students_rows], dtype=object)
+    id_to_idx: Dict[int, int] = {sid: idx for idx, sid in enumerate(ids.tolist())}
 
-    # Load availability
+    # Load availability into per-student bitsets, one dense bit per timeslot
     avail_rows = db.fetch_all(
         "SELECT student_id, timeslot_id FROM student_availability"
     )
+    slot_bits: Dict[int, int] = {}
+    rows_idx: List[int] = []
+    bits: List[int] = []
     for row in avail_rows:
-        sid = row["student_id"]
-        tid = row["timeslot_id"]
-        if sid in students_base:
-            students_base[sid].availability_timeslot_ids.add(tid)
+        idx = id_to_idx.get(row["student_id"])
+        if idx is not None:
+            rows_idx.append(idx)
+            bits.append(slot_bits.setdefault(row["timeslot_id"], len(slot_bits)))
+
+    # Typical course setups have a handful of timeslots; 32-bit words halve
+    # the pairwise AND/popcount work in build_compatibility_matrix
+    if len(slot_bits) <= 32:
+        word_dtype, word_bits = np.uint32, 32
+    else:
+        word_dtype, word_bits = np.uint64, 64
+    n_words = max(1, -(-len(slot_bits) // word_bits))
+    avail_mask = np.zeros((len(ids), n_words), dtype=word_dtype)
+    if bits:
+        bit_arr = np.array(bits, dtype=word_dtype)
+        np.bitwise_or.at(
+            avail_mask,
+            (np.array(rows_idx), (bit_arr // word_bits).astype(np.intp)),
+            word_dtype(1) << (bit_arr % word_dtype(word_bits)),
+        )
 
-    # Group by course
-    by_course: Dict[int, List[Student]] = defaultdict(list)
-    for student in students_base.values():
-        for cid in student.course_ids:
-            by_course[cid].append(student)
+    everyone = StudentArrays(
+        ids=ids,
+        preferred_group_size=prefs,
+        avail_mask=avail_mask,
+        names=names,
+        emails=emails,
+    )
 
+    # Group by course; rows arrive sorted so each course is one contiguous run
+    course_rows = db.fetch_all(
+        "SELECT course_id, student_id FROM student_courses ORDER BY course_id, student_id"
+    )
+    by_course: Dict[int, StudentArrays] = {}
+    for course_id, rows in groupby(course_rows, key=itemgetter("course_id")):
+        idx_list = [
+            id_to_idx[row["student_id"]] for row in rows if row["student_id"] in id_to_idx
+        ]
+        if idx_list:
+            by_course[course_id] = everyone.take(np.array(idx_list))
+    for students in by_course.values():
+        for arr in vars(students).values():
+            arr.flags.writeable = False
     return by_course
 
 
-def compatibility(a: Student, b: Student) -> int:
-    """Compute compatibility score between two students.
+def build_compatibility_matrix(students: StudentArrays) -> np.ndarray:
+    """Compute all pairwise compatibility scores at once.
+
+    Returns an n x n int32 matrix indexed like ``students``; the diagonal is 0.
 
     - Base +5 points (same course context; could be tuned per course later)
-    - +1 per overlapping availability timeslot
+    - +1 per overlapping availability timeslot (vectorized AND + popcount)
     - Small penalty for very different preferred_group_size
     """
-    base_score = 5
-    overlap = len(a.availability_timeslot_ids & b.availability_timeslot_ids)
-    size_diff = abs(a.preferred_group_size - b.preferred_group_size)
-    penalty = 0
-    if size_diff >= 2:
-        penalty = size_diff - 1
-    return max(0, base_score + overlap - penalty)
-
-
-def build_compatibility_matrix(students: List[Student]) -> Dict[Tuple[int, int], int]:
-    scores: Dict[Tuple[int, int], int] = {}
-    for i, s1 in enumerate(students):
-        for j in range(i + 1, len(students)):
-            s2 = students[j]
-            score = compatibility(s1, s2)
-            scores[(s1.id, s2.id)] = score
-            scores[(s2.id, s1.id)] = score
+    masks = students.avail_mask
+    overlap = np.bitwise_count(masks[:, None, :] & masks[None, :, :]).sum(
+        axis=-1, dtype=np.int32
+    )
+    prefs = students.preferred_group_size.astype(np.int32)
+    penalty = np.maximum(0, np.abs(prefs[:, None] - prefs[None, :]) - 1)
+
+    scores = np.maximum(0, BASE_SCORE + overlap - penalty)
+    np.fill_diagonal(scores, 0)
     return scores
 
 
-def form_groups_for_course(students: List[Student]) -> List[List[Student]]:
-    if not students:
-        return []
-    if len(students) == 1:
-        # Leave singleton as its own group (can be handled specially in UI)
-        return [students]
+def _jit(func: Callable[..., Any]) -> Callable[..., Any]:
+    """njit with on-disk caching, so the kernel isn't recompiled on restart.
 
-    # Determine target group size based on median preference, clamped
-    prefs = [max(2, min(5, s.preferred_group_size)) for s in students]
+    Falls back to in-memory compilation when no cache directory is writable
+    (e.g. a read-only deploy), where numba refuses cache=True outright.
+    """
     try:
-        target_size = int(median(prefs))
-    except Exception:
-        target_size = 3
-    target_size = max(2, min(5, target_size))
+        return njit(cache=True)(func)
+    except RuntimeError:
+        return njit(func)
 
-    scores = build_compatibility_matrix(students)
 
-    unassigned: Set[int] = {s.id for s in students}
-    by_id: Dict[int, Student] = {s.id: s for s in students}
-    groups: List[List[Student]] = []
+@_jit
+def _greedy_groups(scores: np.ndarray, target_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Greedy grouping kernel over a compatibility matrix.
 
-    def avg_compat(candidate_id: int, current_ids: List[int]) -> float:
-        if not current_ids:
-            return 0.0
-        total = 0
-        for cid in current_ids:
-            total += scores.get((candidate_id, cid), 0)
-        return total / len(current_ids)
+    Returns ``order`` (student indices in the order they were grouped) and
+    ``offsets`` such that group g is ``order[offsets[g]:offsets[g + 1]]``.
+    Ties go to the lowest index.
+    """
+    n = scores.shape[0]
+    assigned = np.zeros(n, dtype=np.bool_)
+    order = np.empty(n, dtype=np.int64)
+    offsets = np.empty(n + 1, dtype=np.int64)
+    n_groups = 0
+    pos = 0
+
+    # row_sum[i] is i's total compatibility with every still-unassigned
+    # student; it is decremented as students are assigned instead of being
+    # recomputed for every seed pick.
+    row_sum = scores.sum(axis=1)
+    # group_sum[i] is i's total compatibility with the group being built
+    group_sum = np.zeros(n, dtype=scores.dtype)
+
+    while pos < n:
+        start = pos
+        offsets[n_groups] = start
+        n_groups += 1
 
-    while unassigned:
         # Pick seed: student with highest total compatibility with others
-        best_seed_id = None
-        best_seed_total = -1
-        for sid in list(unassigned):
-            total = 0
-            for other in unassigned:
-                if other == sid:
-                    continue
-                total += scores.get((sid, other), 0)
-            if total > best_seed_total:
-                best_seed_total = total
-                best_seed_id = sid
-
-        if best_seed_id is None:
-            break
-
-        current_group_ids: List[int] = [best_seed_id]
-        unassigned.remove(best_seed_id)
-
-        # Greedily add members with highest average compatibility
-        while len(current_group_ids) < target_size and unassigned:
-            best_candidate = None
-            best_score = -1.0
-            for sid in list(unassigned):
-                score = avg_compat(sid, current_group_ids)
-                if score > best_score:
-                    best_score = score
-                    best_candidate = sid
-
-            # If no positive compatibility, still add one student to avoid being stuck
-            if best_candidate is None:
-                best_candidate = next(iter(unassigned))
-
-            current_group_ids.append(best_candidate)
-            unassigned.remove(best_candidate)
-
-        groups.append([by_id[sid] for sid in current_group_ids])
+        seed = -1
+        best = -1
+        for i in range(n):
+            if not assigned[i] and row_sum[i] > best:
+                best = row_sum[i]
+                seed = i
+        group_sum[:] = 0
+        member = seed
+
+        while True:
+            assigned[member] = True
+            order[pos] = member
+            pos += 1
+            for i in range(n):
+                if not assigned[i]:
+                    row_sum[i] -= scores[i, member]
+                    group_sum[i] += scores[i, member]
+
+            if pos - start >= target_size or pos >= n:
+                break
+
+            # Greedily add members with highest average compatibility (the
+            # group size is shared by all candidates, so totals compare the same)
+            member = -1
+            best = -1
+            for i in range(n):
+                if not assigned[i] and group_sum[i] > best:
+                    best = group_sum[i]
+                    member = i
+
+    offsets[n_groups] = n
+    return order, offsets[: n_groups + 1]
+
+
+def form_groups_for_course(students: StudentArrays) -> List[List[int]]:
+    """Split one course's students into groups.
+
+    Returns groups as lists of row indices into ``students``.
+    """
+    n = len(students)
+    if n == 0:
+        return []
+    if n == 1:
+        # Leave singleton as its own group (can be handled specially in UI)
+        return [[0]]
+
+    # Determine target group size based on median preference, clamped
+    prefs = np.clip(students.preferred_group_size, 2, 5)
+    target_size = int(np.median(prefs))
+
+    scores = build_compatibility_matrix(students)
+    order, offsets = _greedy_groups(scores, target_size)
+    groups: List[List[int]] = [
+        order[offsets[g] : offsets[g + 1]].tolist() for g in range(len(offsets) - 1)
+    ]
 
     # If last group is very small (size 1) and there is another group, merge
     if len(groups) >= 2 and len(groups[-1]) == 1:
-        lone = groups.pop()
+        lone = groups.pop()[0]
         # merge lone student into group with best average compatibility
-        lone_student = lone[0]
-        best_group_idx = 0
-        best_group_score = -1
-        for idx, group in enumerate(groups):
-            if not group:
-                continue
-            total = sum(compatibility(lone_student, member) for member in group)
-            avg = total / len(group)
-            if avg > best_group_score:
-                best_group_score = avg
-                best_group_idx = idx
-        groups[best_group_idx].append(lone_student)
+        avgs = [scores[lone, group].mean() for group in groups]
+        groups[int(np.argmax(avgs))].append(lone)
 
     return groups
 
 
-def run_matching() -> Dict[int, List[List[int]]]:
+def run_matching() -> List[Dict[str, Any]]:
     """Run matching for all courses.
 
-    Returns a mapping: {course_id: [[student_ids...], ...]}
+    Returns one entry per new group:
+    {"group_id", "course_id", "group_index", "members": [{"id", "name", "email"}, ...]}
     Also persists study_groups and study_group_members tables.
     """
     by_course = load_students_by_course()
     if not by_course:
-        return {}
+        return []
 
-    # Clear old groups
-    db.execute("DELETE FROM study_group_members")
-    db.execute("DELETE FROM study_groups")
+    # Form every group up front so the writes below are a few bulk statements
+    # and the write lock is held only briefly
+    planned: List[Tuple[int, int, StudentArrays, List[int]]] = []
+    for course_id, students in by_course.items():
+        for group_index, group in enumerate(form_groups_for_course(students), start=1):
+            planned.append((course_id, group_index, students, group))
 
-    result: Dict[int, List[List[int]]] = {}
+    with db.transaction():
+        # Clear old groups
+        db.execute("DELETE FROM study_group_members")
+        db.execute("DELETE FROM study_groups")
 
-    for course_id, students in by_course.items():
-        groups = form_groups_for_course(students)
-        result[course_id] = []
-        group_index = 1
-        for group in groups:
-            group_id = db.execute(
-                "INSERT INTO study_groups (course_id, group_index) VALUES (?, ?)",
-                (course_id, group_index),
-            )
-            member_ids = [s.id for s in group]
-            db.executemany(
-                "INSERT INTO study_group_members (group_id, student_id) VALUES (?, ?)",
-                [(group_id, sid) for sid in member_ids],
-            )
-            result[course_id].append(member_ids)
-            group_index += 1
-
-    return result
+        db.executemany(
+            "INSERT INTO study_groups (course_id, group_index) VALUES (?, ?)",
+            [(course_id, group_index) for course_id, group_index, _, _ in planned],
+        )
+        # sqlite3 drops RETURNING rows from executemany. The table was emptied
+        # above and we hold the write lock, so these are exactly the new rows,
+        # and AUTOINCREMENT hands out ids in insertion order.
+        group_ids = [
+            row["id"] for row in db.fetch_all("SELECT id FROM study_groups ORDER BY id")
+        ]
+
+        member_ids = [students.ids[group].tolist() for _, _, students, group in planned]
+        db.executemany(
+            "INSERT INTO study_group_members (group_id, student_id) VALUES (?, ?)",
+            [
+                (group_id, sid)
+                for group_id, ids in zip(group_ids, member_ids)
+                for sid in ids
+            ],
+        )
+
+    return [
+        {
+            "group_id": group_id,
+            "course_id": course_id,
+            "group_index": group_index,
+            "members": [
+                {"id": sid, "name": name, "email": email}
+                for sid, name, email in zip(
+                    ids, students.names[group], students.emails[group]
+                )
+            ],
+        }
+        for group_id, ids, (course_id, group_index, students, group) in zip(
+            group_ids, member_ids, planned
+        )
+    ]
@@ -1,15 +1,35 @@
 from dataclasses import dataclass
-from typing import List, Set
+
+import numpy as np
 
 
 @dataclass
-class Student:
-    id: int
-    name: str
-    email: str
-    preferred_group_size: int
-    course_ids: List[int]
-    availability_timeslot_ids: Set[int]
+class StudentArrays:
+    """Struct-of-arrays view of students, as consumed by the matcher.
+
+    Row i of every array describes the same student. Bit k of
+    ``avail_mask[i]`` (spread over uint32 words when there are at most 32
+    timeslots, uint64 otherwise) is set when the student is available in the
+    k-th known timeslot.
+    """
+
+    ids: np.ndarray  # int64[n]
+    preferred_group_size: np.ndarray  # int8[n]
+    avail_mask: np.ndarray  # uint32 or uint64[n, words]
+    names: np.ndarray  # object[n], carried along for building responses
+    emails: np.ndarray  # object[n]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def take(self, idx: np.ndarray) -> "StudentArrays":
+        return StudentArrays(
+            ids=self.ids[idx],
+            preferred_group_size=self.preferred_group_size[idx],
+            avail_mask=self.avail_mask[idx],
+            names=self.names[idx],
+            emails=self.emails[idx],
+        )
 
 
 @dataclass
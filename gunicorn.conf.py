@@ -0,0 +1,8 @@
+# Production server settings, picked up automatically by:
+#   gunicorn backend.app:app
+# gevent workers multiplex many client connections over socket I/O. SQLite
+# calls and the CPU-bound matcher still block their worker, hence 2 workers.
+
+worker_class = "gevent"
+workers = 2
+worker_connections = 1000